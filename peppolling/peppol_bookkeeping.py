@@ -1,17 +1,127 @@
 import os
 import base64
+from io import BytesIO
 from datetime import datetime, date, timedelta
 from decimal import Decimal, ROUND_HALF_UP
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from lxml import etree
 from sqlalchemy import (
-    create_engine, Column, Integer, String, Float, Boolean,
+    create_engine, event, Column, Integer, String, Float, Boolean,
     DateTime, ForeignKey
 )
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
 
+# Decimal quantizers for parsing amounts (cents) and VAT rates (basis points)
+_Q2 = Decimal("0.01")
+_Q4 = Decimal("0.0001")
+
+# -------------------------
+# UBL namespaces and tags
+# -------------------------
+
+NS_UBL = "urn:oasis:names:specification:ubl:schema:xsd:Invoice-2"
+NS_CBC = "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2"
+NS_CAC = "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"
+
+NSMAP = {None: NS_UBL, "cbc": NS_CBC, "cac": NS_CAC}
+
+# Clark-notation ("{namespace}tag") names, built once at import time
+CBC_BUYER_REFERENCE = f"{{{NS_CBC}}}BuyerReference"
+CBC_CITY_NAME = f"{{{NS_CBC}}}CityName"
+CBC_COMPANY_ID = f"{{{NS_CBC}}}CompanyID"
+CBC_CUSTOMIZATION_ID = f"{{{NS_CBC}}}CustomizationID"
+CBC_DESCRIPTION = f"{{{NS_CBC}}}Description"
+CBC_DOCUMENT_CURRENCY_CODE = f"{{{NS_CBC}}}DocumentCurrencyCode"
+CBC_ENDPOINT_ID = f"{{{NS_CBC}}}EndpointID"
+CBC_ID = f"{{{NS_CBC}}}ID"
+CBC_IDENTIFICATION_CODE = f"{{{NS_CBC}}}IdentificationCode"
+CBC_INVOICE_TYPE_CODE = f"{{{NS_CBC}}}InvoiceTypeCode"
+CBC_INVOICED_QUANTITY = f"{{{NS_CBC}}}InvoicedQuantity"
+CBC_ISSUE_DATE = f"{{{NS_CBC}}}IssueDate"
+CBC_LINE_COUNT_NUMERIC = f"{{{NS_CBC}}}LineCountNumeric"
+CBC_LINE_EXTENSION_AMOUNT = f"{{{NS_CBC}}}LineExtensionAmount"
+CBC_NAME = f"{{{NS_CBC}}}Name"
+CBC_NOTE = f"{{{NS_CBC}}}Note"
+CBC_PAYABLE_AMOUNT = f"{{{NS_CBC}}}PayableAmount"
+CBC_PAYMENT_DUE_DATE = f"{{{NS_CBC}}}PaymentDueDate"
+CBC_PAYMENT_MEANS_CODE = f"{{{NS_CBC}}}PaymentMeansCode"
+CBC_PERCENT = f"{{{NS_CBC}}}Percent"
+CBC_POSTAL_ZONE = f"{{{NS_CBC}}}PostalZone"
+CBC_PRICE_AMOUNT = f"{{{NS_CBC}}}PriceAmount"
+CBC_PROFILE_ID = f"{{{NS_CBC}}}ProfileID"
+CBC_REGISTRATION_NAME = f"{{{NS_CBC}}}RegistrationName"
+CBC_STREET_NAME = f"{{{NS_CBC}}}StreetName"
+CBC_TAX_AMOUNT = f"{{{NS_CBC}}}TaxAmount"
+CBC_TAX_EXCLUSIVE_AMOUNT = f"{{{NS_CBC}}}TaxExclusiveAmount"
+CBC_TAX_INCLUSIVE_AMOUNT = f"{{{NS_CBC}}}TaxInclusiveAmount"
+CBC_TAXABLE_AMOUNT = f"{{{NS_CBC}}}TaxableAmount"
+
+CAC_ACCOUNTING_CUSTOMER_PARTY = f"{{{NS_CAC}}}AccountingCustomerParty"
+CAC_ACCOUNTING_SUPPLIER_PARTY = f"{{{NS_CAC}}}AccountingSupplierParty"
+CAC_CLASSIFIED_TAX_CATEGORY = f"{{{NS_CAC}}}ClassifiedTaxCategory"
+CAC_COUNTRY = f"{{{NS_CAC}}}Country"
+CAC_INVOICE_LINE = f"{{{NS_CAC}}}InvoiceLine"
+CAC_ITEM = f"{{{NS_CAC}}}Item"
+CAC_LEGAL_MONETARY_TOTAL = f"{{{NS_CAC}}}LegalMonetaryTotal"
+CAC_PARTY = f"{{{NS_CAC}}}Party"
+CAC_PARTY_IDENTIFICATION = f"{{{NS_CAC}}}PartyIdentification"
+CAC_PARTY_LEGAL_ENTITY = f"{{{NS_CAC}}}PartyLegalEntity"
+CAC_PARTY_NAME = f"{{{NS_CAC}}}PartyName"
+CAC_PARTY_TAX_SCHEME = f"{{{NS_CAC}}}PartyTaxScheme"
+CAC_PAYMENT_MEANS = f"{{{NS_CAC}}}PaymentMeans"
+CAC_PAYMENT_TERMS = f"{{{NS_CAC}}}PaymentTerms"
+CAC_POSTAL_ADDRESS = f"{{{NS_CAC}}}PostalAddress"
+CAC_PRICE = f"{{{NS_CAC}}}Price"
+CAC_TAX_CATEGORY = f"{{{NS_CAC}}}TaxCategory"
+CAC_TAX_SCHEME = f"{{{NS_CAC}}}TaxScheme"
+CAC_TAX_SUBTOTAL = f"{{{NS_CAC}}}TaxSubtotal"
+CAC_TAX_TOTAL = f"{{{NS_CAC}}}TaxTotal"
+
+NS = {"cbc": NS_CBC, "cac": NS_CAC}
+
+
+# Compiled XPath expressions for incoming invoices, evaluated on a top-level
+# child of the root. smart_strings=False returns plain str instead of
+# results that keep a reference back to the parsed tree.
+def _xpath(path):
+    return etree.XPath(path, namespaces=NS, smart_strings=False)
+
+
+XP_PARTY_NAME = _xpath("cac:Party/cac:PartyName/cbc:Name")
+XP_PAYABLE_AMOUNT = _xpath("cbc:PayableAmount/text()")
+XP_TAX_SUBTOTALS = _xpath("cac:TaxSubtotal/cbc:TaxAmount/text()")
+
+# Top-level elements read while streaming an incoming invoice. InvoiceLine is
+# only listed so that each line is freed as soon as it has been parsed.
+SCAN_HEADER_FIELDS = {
+    CBC_ID: "invoice_id",
+    CBC_ISSUE_DATE: "issue_date",
+    CBC_DOCUMENT_CURRENCY_CODE: "currency",
+}
+SCAN_TAGS = (
+    *SCAN_HEADER_FIELDS,
+    CAC_ACCOUNTING_SUPPLIER_PARTY,
+    CAC_ACCOUNTING_CUSTOMER_PARTY,
+    CAC_TAX_TOTAL,
+    CAC_LEGAL_MONETARY_TOTAL,
+    CAC_INVOICE_LINE,
+)
+
+# Parser options for untrusted inbound UBL: entities are never expanded (no
+# XXE file reads, no entity-expansion bombs), nothing is fetched over the
+# network, and libxml2 keeps its default size limits.
+SCAN_PARSER_OPTIONS = {
+    "resolve_entities": False,
+    "no_network": True,
+    "huge_tree": False,
+}
+
 # -------------------------
 # SQLAlchemy setup
 # -------------------------
@@ -23,7 +133,7 @@ class User(Base):
     __tablename__ = "users"
 
     id = Column(Integer, primary_key=True)
-    company = Column(String, nullable=False)
+    company = Column(String, nullable=False, index=True)
     name = Column(String)
     vat_number = Column(String)
     country_code = Column(String, default="BE")
@@ -88,6 +198,12 @@ class PeppolBookkeeping:
     - Import invoices into a simple bookkeeping model
     """
 
+    # Concurrent message detail requests in receive_invoices
+    DETAIL_FETCH_WORKERS = 16
+
+    # (connect, read) timeout in seconds for every Peppyrus request
+    HTTP_TIMEOUT = (5, 30)
+
     def __init__(
         self,
         db_url="sqlite:///bookkeeping.db",
@@ -103,15 +219,46 @@ class PeppolBookkeeping:
     ):
         # DB setup
         self.engine = create_engine(db_url)
+        if self.engine.dialect.name == "sqlite":
+            event.listen(self.engine, "connect", self._set_sqlite_pragmas)
+            event.listen(self.engine, "begin", self._begin_sqlite)
         Base.metadata.create_all(self.engine)
+        # create_all skips tables that already exist, so add indexes introduced
+        # after a database was created (e.g. users.company) separately
+        for index in User.__table__.indexes:
+            index.create(self.engine, checkfirst=True)
         self.Session = sessionmaker(bind=self.engine)
         self.session = self.Session()
 
+        # Company name -> User id, filled while importing incoming invoices
+        self._user_by_company = {}
+
         # Peppol / Peppyrus config
         self.PEPPOL_API_KEY = peppol_api_key or os.getenv("PEPPOL_API_KEY", "")
         self.PEPPOL_ENDPOINT = peppol_endpoint.rstrip("/") + "/"
         self.SENDER_PEPPOL_ID = sender_peppol_id or os.getenv("PEPPOL_SENDER_ID", "")
 
+        # Shared HTTP session: keeps connections to Peppyrus alive between calls
+        self.http = requests.Session()
+        self.http.headers.update({
+            "accept": "application/json",
+            "X-Api-Key": self.PEPPOL_API_KEY
+        })
+        # Retry transient gateway errors on GETs only: a POST that reached the
+        # access point may already have sent the invoice. Connection errors are
+        # retried for every method, as nothing was sent yet. raise_on_status=False
+        # hands the last response back so callers still check status_code.
+        retry = Retry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({"GET"}),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=32, max_retries=retry)
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+
         # Sender (supplier) info
         self.sender_company = sender_company or "Example Supplier"
         self.sender_vat = (sender_vat or "BE0123456789").replace(" ", "").replace(".", "")
@@ -125,24 +272,64 @@ class PeppolBookkeeping:
     # -------------------------
 
     @staticmethod
-    def _qname(ns, tag):
-        return etree.QName(ns, tag)
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        # pysqlite starts transactions on its own and not before a SAVEPOINT, which
+        # breaks begin_nested(); leave that to SQLAlchemy (see _begin_sqlite)
+        dbapi_connection.isolation_level = None
+
+        # WAL with synchronous=NORMAL only fsyncs at checkpoints instead of on
+        # every commit, and readers no longer block the writer
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-20000")
+        cursor.close()
 
     @staticmethod
-    def _safe_str(val):
-        return "" if val is None else str(val)
+    def _begin_sqlite(conn):
+        conn.exec_driver_sql("BEGIN")
 
     @staticmethod
-    def _d2(value) -> Decimal:
-        return Decimal(str(value)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+    def _safe_str(val):
+        return "" if val is None else str(val)
 
     @staticmethod
     def _d0(value) -> Decimal:
         return Decimal(str(value))
 
     @staticmethod
-    def _fmt_amount(value: Decimal) -> str:
-        return str(value.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP))
+    def _cents(value) -> int:
+        """Amount as integer cents, rounded half-up."""
+        return int(Decimal(str(value)).quantize(_Q2, rounding=ROUND_HALF_UP).scaleb(2))
+
+    @staticmethod
+    def _basis_points(value) -> int:
+        """Rate as integer basis points (0.21 -> 2100), rounded half-up."""
+        return int(Decimal(str(value)).quantize(_Q4, rounding=ROUND_HALF_UP).scaleb(4))
+
+    @staticmethod
+    def _div_half_up(numerator: int, denominator: int) -> int:
+        """Integer division rounding halves away from zero, like ROUND_HALF_UP."""
+        quotient, remainder = divmod(abs(numerator), denominator)
+        if 2 * remainder >= denominator:
+            quotient += 1
+        return quotient if numerator >= 0 else -quotient
+
+    @staticmethod
+    def _fmt_cents(cents: int) -> str:
+        sign = "-" if cents < 0 else ""
+        units, cents = divmod(abs(cents), 100)
+        return f"{sign}{units}.{cents:02d}"
+
+    @staticmethod
+    def _first(values):
+        return values[0] if values else None
+
+    @staticmethod
+    def _first_text(elements):
+        # Same as findtext: "" for an empty element, None if there is none
+        return (elements[0].text or "") if elements else None
 
     # -------------------------
     # Transaction creation
@@ -161,7 +348,8 @@ class PeppolBookkeeping:
         end=None,
         intervat=False,
         annotation=None,
-        proof_filename=None
+        proof_filename=None,
+        commit=True
     ):
         record = Transaction()
         record.name = name
@@ -178,14 +366,15 @@ class PeppolBookkeeping:
         record.proof = proof_filename
 
         self.session.add(record)
-        self.session.commit()
+        if commit:
+            self.session.commit()
         return record
 
     # -------------------------
     # UBL invoice generation
     # -------------------------
 
-    def generate_invoice_xml(self, supplier: User, buyer: User, items, invoice_id: str, issue_date: date, due_date: date = None):
+    def generate_invoice_xml(self, supplier: User, buyer: User, items, invoice_id: str, issue_date: date, due_date: date = None, pretty: bool = False):
         """
         Generate a UBL 2.1 EN16931/Peppol BIS Billing 3.0 invoice.
 
@@ -195,172 +384,184 @@ class PeppolBookkeeping:
             - quantity
             - unit_price
             - vat_pct (e.g. 0.21)
-        """
 
-        ns_ubl = "urn:oasis:names:specification:ubl:schema:xsd:Invoice-2"
-        ns_cbc = "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2"
-        ns_cac = "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"
+        pretty: indent the XML for reading/debugging (not needed for sending)
+        """
 
-        qname = self._qname
         d0 = self._d0
-        d2 = self._d2
-        fmt_amount = self._fmt_amount
+        to_cents = self._cents
+        to_bp = self._basis_points
+        div_half_up = self._div_half_up
+        fmt_cents = self._fmt_cents
         safe_str = self._safe_str
+        sub = etree.SubElement
 
         if not due_date:
             due_date = issue_date + timedelta(days=30)
 
-        invoice_et = etree.Element("Invoice", nsmap={None: ns_ubl, "cbc": ns_cbc, "cac": ns_cac})
+        invoice_et = etree.Element("Invoice", nsmap=NSMAP)
 
         # HEADER
-        etree.SubElement(invoice_et, qname(ns_cbc, "CustomizationID")).text = (
+        sub(invoice_et, CBC_CUSTOMIZATION_ID).text = (
             "urn:cen.eu:en16931:2017#compliant#urn:fdc:peppol.eu:2017:poacc:billing:3.0"
         )
-        etree.SubElement(invoice_et, qname(ns_cbc, "ProfileID")).text = (
+        sub(invoice_et, CBC_PROFILE_ID).text = (
             "urn:fdc:peppol.eu:2017:poacc:billing:01:1.0"
         )
-        etree.SubElement(invoice_et, qname(ns_cbc, "ID")).text = invoice_id
-        etree.SubElement(invoice_et, qname(ns_cbc, "IssueDate")).text = str(issue_date)
-        etree.SubElement(invoice_et, qname(ns_cbc, "InvoiceTypeCode")).text = "380"
-        etree.SubElement(invoice_et, qname(ns_cbc, "DocumentCurrencyCode")).text = "EUR"
-        etree.SubElement(invoice_et, qname(ns_cbc, "LineCountNumeric")).text = str(len(items))
-        etree.SubElement(invoice_et, qname(ns_cbc, "BuyerReference")).text = buyer.company
+        sub(invoice_et, CBC_ID).text = invoice_id
+        sub(invoice_et, CBC_ISSUE_DATE).text = str(issue_date)
+        sub(invoice_et, CBC_INVOICE_TYPE_CODE).text = "380"
+        sub(invoice_et, CBC_DOCUMENT_CURRENCY_CODE).text = "EUR"
+        sub(invoice_et, CBC_LINE_COUNT_NUMERIC).text = str(len(items))
+        sub(invoice_et, CBC_BUYER_REFERENCE).text = buyer.company
 
         # SELLER
-        supplier_party = etree.SubElement(invoice_et, qname(ns_cac, "AccountingSupplierParty"))
-        party = etree.SubElement(supplier_party, qname(ns_cac, "Party"))
+        supplier_party = sub(invoice_et, CAC_ACCOUNTING_SUPPLIER_PARTY)
+        party = sub(supplier_party, CAC_PARTY)
 
         if supplier.peppol_id:
             scheme = supplier.peppol_id.split(":")[0]
-            etree.SubElement(party, qname(ns_cbc, "EndpointID"), schemeID=scheme).text = supplier.peppol_id
+            sub(party, CBC_ENDPOINT_ID, schemeID=scheme).text = supplier.peppol_id
 
-        party_ident = etree.SubElement(party, qname(ns_cac, "PartyIdentification"))
-        etree.SubElement(party_ident, qname(ns_cbc, "ID"), schemeID="0208").text = supplier.vat_number or "0000000000"
+        party_ident = sub(party, CAC_PARTY_IDENTIFICATION)
+        sub(party_ident, CBC_ID, schemeID="0208").text = supplier.vat_number or "0000000000"
 
-        party_name = etree.SubElement(party, qname(ns_cac, "PartyName"))
-        etree.SubElement(party_name, qname(ns_cbc, "Name")).text = supplier.company
+        party_name = sub(party, CAC_PARTY_NAME)
+        sub(party_name, CBC_NAME).text = supplier.company
 
-        address = etree.SubElement(party, qname(ns_cac, "PostalAddress"))
-        etree.SubElement(address, qname(ns_cbc, "StreetName")).text = supplier.street or ""
-        etree.SubElement(address, qname(ns_cbc, "CityName")).text = supplier.city or ""
-        etree.SubElement(address, qname(ns_cbc, "PostalZone")).text = supplier.postal_code or ""
-        country = etree.SubElement(address, qname(ns_cac, "Country"))
-        etree.SubElement(country, qname(ns_cbc, "IdentificationCode")).text = supplier.country_code or "BE"
+        address = sub(party, CAC_POSTAL_ADDRESS)
+        sub(address, CBC_STREET_NAME).text = supplier.street or ""
+        sub(address, CBC_CITY_NAME).text = supplier.city or ""
+        sub(address, CBC_POSTAL_ZONE).text = supplier.postal_code or ""
+        country = sub(address, CAC_COUNTRY)
+        sub(country, CBC_IDENTIFICATION_CODE).text = supplier.country_code or "BE"
 
-        party_tax = etree.SubElement(party, qname(ns_cac, "PartyTaxScheme"))
-        etree.SubElement(party_tax, qname(ns_cbc, "CompanyID")).text = supplier.vat_number or ""
-        tax_scheme = etree.SubElement(party_tax, qname(ns_cac, "TaxScheme"))
-        etree.SubElement(tax_scheme, qname(ns_cbc, "ID")).text = "VAT"
+        party_tax = sub(party, CAC_PARTY_TAX_SCHEME)
+        sub(party_tax, CBC_COMPANY_ID).text = supplier.vat_number or ""
+        tax_scheme = sub(party_tax, CAC_TAX_SCHEME)
+        sub(tax_scheme, CBC_ID).text = "VAT"
 
-        party_legal = etree.SubElement(party, qname(ns_cac, "PartyLegalEntity"))
-        etree.SubElement(party_legal, qname(ns_cbc, "RegistrationName")).text = supplier.company
+        party_legal = sub(party, CAC_PARTY_LEGAL_ENTITY)
+        sub(party_legal, CBC_REGISTRATION_NAME).text = supplier.company
 
         # BUYER
-        customer_party = etree.SubElement(invoice_et, qname(ns_cac, "AccountingCustomerParty"))
-        party_c = etree.SubElement(customer_party, qname(ns_cac, "Party"))
+        customer_party = sub(invoice_et, CAC_ACCOUNTING_CUSTOMER_PARTY)
+        party_c = sub(customer_party, CAC_PARTY)
 
         if buyer.peppol_id:
             buyer_scheme = buyer.peppol_id.split(":")[0]
-            etree.SubElement(party_c, qname(ns_cbc, "EndpointID"), schemeID=buyer_scheme).text = buyer.peppol_id
+            sub(party_c, CBC_ENDPOINT_ID, schemeID=buyer_scheme).text = buyer.peppol_id
 
-        party_c_name = etree.SubElement(party_c, qname(ns_cac, "PartyName"))
-        etree.SubElement(party_c_name, qname(ns_cbc, "Name")).text = buyer.company
+        party_c_name = sub(party_c, CAC_PARTY_NAME)
+        sub(party_c_name, CBC_NAME).text = buyer.company
 
-        address_c = etree.SubElement(party_c, qname(ns_cac, "PostalAddress"))
-        etree.SubElement(address_c, qname(ns_cbc, "StreetName")).text = buyer.street or ""
-        etree.SubElement(address_c, qname(ns_cbc, "CityName")).text = buyer.city or ""
-        etree.SubElement(address_c, qname(ns_cbc, "PostalZone")).text = buyer.postal_code or ""
-        country_c = etree.SubElement(address_c, qname(ns_cac, "Country"))
-        etree.SubElement(country_c, qname(ns_cbc, "IdentificationCode")).text = buyer.country_code or "BE"
+        address_c = sub(party_c, CAC_POSTAL_ADDRESS)
+        sub(address_c, CBC_STREET_NAME).text = buyer.street or ""
+        sub(address_c, CBC_CITY_NAME).text = buyer.city or ""
+        sub(address_c, CBC_POSTAL_ZONE).text = buyer.postal_code or ""
+        country_c = sub(address_c, CAC_COUNTRY)
+        sub(country_c, CBC_IDENTIFICATION_CODE).text = buyer.country_code or "BE"
 
-        party_c_legal = etree.SubElement(party_c, qname(ns_cac, "PartyLegalEntity"))
-        etree.SubElement(party_c_legal, qname(ns_cbc, "RegistrationName")).text = buyer.company
+        party_c_legal = sub(party_c, CAC_PARTY_LEGAL_ENTITY)
+        sub(party_c_legal, CBC_REGISTRATION_NAME).text = buyer.company
 
         # COMPUTE TOTALS
-        vat_groups = defaultdict(lambda: {"taxable": Decimal("0.00"), "tax": Decimal("0.00")})
-        total_without_tax = Decimal("0.00")
-        total_tax = Decimal("0.00")
+        # Fixed-point integers: amounts in cents, VAT rates in basis points and
+        # VAT amounts in cents * basis points, so per-line tax stays exact
+        # until it is rounded to cents for output.
+        vat_groups = defaultdict(lambda: {"taxable": 0, "tax": 0})
+        total_without_tax = 0
+        total_tax = 0
+
+        # Parsed once here and reused when emitting the invoice lines
+        lines = []
+
+        # VAT rates repeat across lines, so each distinct rate is parsed only
+        # once. Keyed on str(value), which is all the parser uses.
+        vat_bp_cache = {}
 
         for item in items:
             quantity = d0(item.get("quantity", 0))
-            unit_price = d2(item.get("unit_price", 0))
-            line_total = d2(quantity * unit_price)
+            unit_price = to_cents(item.get("unit_price", 0))
+            qty_num, qty_den = quantity.as_integer_ratio()
+            line_total = div_half_up(qty_num * unit_price, qty_den)
 
-            vat_pct = Decimal(str(item.get("vat_pct", 0)))
-            if vat_pct < Decimal("0"):
-                vat_pct = Decimal("0")
+            key = str(item.get("vat_pct", 0))
+            vat_bp = vat_bp_cache.get(key)
+            if vat_bp is None:
+                vat_bp = vat_bp_cache[key] = max(to_bp(key), 0)
 
-            vat_amount = line_total * vat_pct
-            vat_groups[vat_pct]["taxable"] += line_total
-            vat_groups[vat_pct]["tax"] += vat_amount
+            vat_amount = line_total * vat_bp
+            vat_groups[vat_bp]["taxable"] += line_total
+            vat_groups[vat_bp]["tax"] += vat_amount
 
             total_without_tax += line_total
             total_tax += vat_amount
+            lines.append((item, quantity, unit_price, line_total, vat_bp))
+
+        total_with_tax = div_half_up(total_without_tax * 10000 + total_tax, 10000)
+        total_tax = div_half_up(total_tax, 10000)
+
+        # Percent text per VAT rate, shared by the subtotals and every line.
+        # Basis points have the same two decimals as a percentage: 2100 -> "21.00"
+        percent_text = {vat_bp: fmt_cents(vat_bp) for vat_bp in vat_groups}
 
         # TAX TOTAL
-        tax_total = etree.SubElement(invoice_et, qname(ns_cac, "TaxTotal"))
-        etree.SubElement(tax_total, qname(ns_cbc, "TaxAmount"), currencyID="EUR").text = fmt_amount(total_tax)
+        tax_total = sub(invoice_et, CAC_TAX_TOTAL)
+        sub(tax_total, CBC_TAX_AMOUNT, currencyID="EUR").text = fmt_cents(total_tax)
 
-        for vat_pct, values in vat_groups.items():
-            subtotal = etree.SubElement(tax_total, qname(ns_cac, "TaxSubtotal"))
-            etree.SubElement(subtotal, qname(ns_cbc, "TaxableAmount"), currencyID="EUR").text = fmt_amount(values["taxable"])
-            etree.SubElement(subtotal, qname(ns_cbc, "TaxAmount"), currencyID="EUR").text = fmt_amount(values["tax"])
+        for vat_bp, values in vat_groups.items():
+            subtotal = sub(tax_total, CAC_TAX_SUBTOTAL)
+            sub(subtotal, CBC_TAXABLE_AMOUNT, currencyID="EUR").text = fmt_cents(values["taxable"])
+            sub(subtotal, CBC_TAX_AMOUNT, currencyID="EUR").text = fmt_cents(div_half_up(values["tax"], 10000))
 
-            category = etree.SubElement(subtotal, qname(ns_cac, "TaxCategory"))
-            etree.SubElement(category, qname(ns_cbc, "ID")).text = "S"
-            etree.SubElement(category, qname(ns_cbc, "Percent")).text = fmt_amount(vat_pct * Decimal("100"))
-            scheme = etree.SubElement(category, qname(ns_cac, "TaxScheme"))
-            etree.SubElement(scheme, qname(ns_cbc, "ID")).text = "VAT"
+            category = sub(subtotal, CAC_TAX_CATEGORY)
+            sub(category, CBC_ID).text = "S"
+            sub(category, CBC_PERCENT).text = percent_text[vat_bp]
+            scheme = sub(category, CAC_TAX_SCHEME)
+            sub(scheme, CBC_ID).text = "VAT"
 
         # PAYMENT TERMS (BT-9 via Note)
-        payment_terms = etree.SubElement(invoice_et, qname(ns_cac, "PaymentTerms"))
-        etree.SubElement(payment_terms, qname(ns_cbc, "Note")).text = f"Payment due by {due_date}"
+        payment_terms = sub(invoice_et, CAC_PAYMENT_TERMS)
+        sub(payment_terms, CBC_NOTE).text = f"Payment due by {due_date}"
 
         # LEGAL MONETARY TOTAL
-        monetary = etree.SubElement(invoice_et, qname(ns_cac, "LegalMonetaryTotal"))
-        etree.SubElement(monetary, qname(ns_cbc, "LineExtensionAmount"), currencyID="EUR").text = fmt_amount(total_without_tax)
-        etree.SubElement(monetary, qname(ns_cbc, "TaxExclusiveAmount"), currencyID="EUR").text = fmt_amount(total_without_tax)
-        etree.SubElement(monetary, qname(ns_cbc, "TaxInclusiveAmount"), currencyID="EUR").text = fmt_amount(total_without_tax + total_tax)
-        etree.SubElement(monetary, qname(ns_cbc, "PayableAmount"), currencyID="EUR").text = fmt_amount(total_without_tax + total_tax)
+        monetary = sub(invoice_et, CAC_LEGAL_MONETARY_TOTAL)
+        sub(monetary, CBC_LINE_EXTENSION_AMOUNT, currencyID="EUR").text = fmt_cents(total_without_tax)
+        sub(monetary, CBC_TAX_EXCLUSIVE_AMOUNT, currencyID="EUR").text = fmt_cents(total_without_tax)
+        sub(monetary, CBC_TAX_INCLUSIVE_AMOUNT, currencyID="EUR").text = fmt_cents(total_with_tax)
+        sub(monetary, CBC_PAYABLE_AMOUNT, currencyID="EUR").text = fmt_cents(total_with_tax)
 
         # INVOICE LINES
-        for idx, item in enumerate(items, start=1):
-            quantity = d0(item.get("quantity", 0))
-            unit_price = d2(item.get("unit_price", 0))
-            line_total = d2(quantity * unit_price)
+        for idx, (item, quantity, unit_price, line_total, vat_bp) in enumerate(lines, start=1):
+            line = sub(invoice_et, CAC_INVOICE_LINE)
+            sub(line, CBC_ID).text = str(idx)
+            sub(line, CBC_INVOICED_QUANTITY, unitCode="EA").text = str(quantity)
+            sub(line, CBC_LINE_EXTENSION_AMOUNT, currencyID="EUR").text = fmt_cents(line_total)
 
-            line = etree.SubElement(invoice_et, qname(ns_cac, "InvoiceLine"))
-            etree.SubElement(line, qname(ns_cbc, "ID")).text = str(idx)
-            etree.SubElement(line, qname(ns_cbc, "InvoicedQuantity"), unitCode="EA").text = str(quantity)
-            etree.SubElement(line, qname(ns_cbc, "LineExtensionAmount"), currencyID="EUR").text = fmt_amount(line_total)
-
-            item_elem = etree.SubElement(line, qname(ns_cac, "Item"))
+            item_elem = sub(line, CAC_ITEM)
             desc = safe_str(item.get("description", ""))
             if desc:
-                etree.SubElement(item_elem, qname(ns_cbc, "Description")).text = desc
+                sub(item_elem, CBC_DESCRIPTION).text = desc
 
             item_name = safe_str(item.get("name", "")) or desc or f"Item {idx}"
-            etree.SubElement(item_elem, qname(ns_cbc, "Name")).text = item_name
-
-            vat_pct = Decimal(str(item.get("vat_pct", 0)))
-            if vat_pct < Decimal("0"):
-                vat_pct = Decimal("0")
+            sub(item_elem, CBC_NAME).text = item_name
 
-            tax_cat = etree.SubElement(item_elem, qname(ns_cac, "ClassifiedTaxCategory"))
-            etree.SubElement(tax_cat, qname(ns_cbc, "ID")).text = "S"
-            etree.SubElement(tax_cat, qname(ns_cbc, "Percent")).text = fmt_amount(vat_pct * Decimal("100"))
-            tax_scheme = etree.SubElement(tax_cat, qname(ns_cac, "TaxScheme"))
-            etree.SubElement(tax_scheme, qname(ns_cbc, "ID")).text = "VAT"
+            tax_cat = sub(item_elem, CAC_CLASSIFIED_TAX_CATEGORY)
+            sub(tax_cat, CBC_ID).text = "S"
+            sub(tax_cat, CBC_PERCENT).text = percent_text[vat_bp]
+            tax_scheme = sub(tax_cat, CAC_TAX_SCHEME)
+            sub(tax_scheme, CBC_ID).text = "VAT"
 
-            price = etree.SubElement(line, qname(ns_cac, "Price"))
-            etree.SubElement(price, qname(ns_cbc, "PriceAmount"), currencyID="EUR").text = fmt_amount(unit_price)
+            price = sub(line, CAC_PRICE)
+            sub(price, CBC_PRICE_AMOUNT, currencyID="EUR").text = fmt_cents(unit_price)
 
         # PAYMENT MEANS (optional, after lines)
-        payment_means = etree.SubElement(invoice_et, qname(ns_cac, "PaymentMeans"))
-        etree.SubElement(payment_means, qname(ns_cbc, "PaymentMeansCode")).text = "31"
-        etree.SubElement(payment_means, qname(ns_cbc, "PaymentDueDate")).text = str(due_date)
+        payment_means = sub(invoice_et, CAC_PAYMENT_MEANS)
+        sub(payment_means, CBC_PAYMENT_MEANS_CODE).text = "31"
+        sub(payment_means, CBC_PAYMENT_DUE_DATE).text = str(due_date)
 
-        xml_bytes = etree.tostring(invoice_et, pretty_print=True, xml_declaration=True, encoding="UTF-8")
+        xml_bytes = etree.tostring(invoice_et, pretty_print=pretty, xml_declaration=True, encoding="UTF-8")
         return xml_bytes
 
     # -------------------------
@@ -368,15 +569,11 @@ class PeppolBookkeeping:
     # -------------------------
 
     def send_invoice(self, xml_bytes: bytes):
-        headers = {
-            "accept": "application/json",
-            "X-Api-Key": self.PEPPOL_API_KEY,
-            "Content-Type": "application/xml"
-        }
-        resp = requests.post(
+        resp = self.http.post(
             self.PEPPOL_ENDPOINT + "v1/message/send",
-            headers=headers,
-            data=xml_bytes
+            headers={"Content-Type": "application/xml"},
+            data=xml_bytes,
+            timeout=self.HTTP_TIMEOUT
         )
         return resp.status_code, resp.text
 
@@ -385,15 +582,10 @@ class PeppolBookkeeping:
     # -------------------------
 
     def receive_invoices(self):
-        headers = {
-            "accept": "application/json",
-            "X-Api-Key": self.PEPPOL_API_KEY
-        }
-
-        resp = requests.get(
+        resp = self.http.get(
             self.PEPPOL_ENDPOINT + "v1/message/list",
-            headers=headers,
-            params={"folder": "INBOX"}
+            params={"folder": "INBOX"},
+            timeout=self.HTTP_TIMEOUT
         )
 
         if resp.status_code == 404:
@@ -403,106 +595,207 @@ class PeppolBookkeeping:
             raise RuntimeError(f"Error retrieving invoices: {resp.status_code}, {resp.text}")
 
         messages = resp.json() or []
-        results = []
+        parsed = []
 
-        for msg in messages:
-            msg_id = msg["id"]
-            detail_resp = requests.get(
-                self.PEPPOL_ENDPOINT + f"v1/message/{msg_id}",
-                headers=headers
+        def fetch_detail(msg):
+            return self.http.get(
+                self.PEPPOL_ENDPOINT + f"v1/message/{msg['id']}",
+                timeout=self.HTTP_TIMEOUT
             )
-            if detail_resp.status_code != 200:
-                continue
 
-            detail = detail_resp.json()
-            result = self.process_incoming_invoice(msg, detail)
-            results.append(result)
+        # Detail fetches run concurrently; importing stays on this thread so
+        # the SQLAlchemy session is never shared between threads.
+        with ThreadPoolExecutor(max_workers=self.DETAIL_FETCH_WORKERS) as pool:
+            for msg, detail_resp in zip(messages, pool.map(fetch_detail, messages)):
+                if detail_resp.status_code != 200:
+                    continue
+
+                detail = detail_resp.json()
+                parsed.append(self._parse_incoming_invoice(msg, detail))
 
-        return results
+        return self._import_invoices(parsed)
 
     # -------------------------
     # Process one incoming invoice
     # -------------------------
 
+    @staticmethod
+    def _scan_invoice(xml_bytes: bytes) -> dict:
+        """
+        Stream over the top-level children of a UBL invoice and collect the
+        fields needed for import. Children are dropped once read, so only one
+        top-level subtree (e.g. a single InvoiceLine) is held in memory.
+        """
+        first = PeppolBookkeeping._first
+        first_text = PeppolBookkeeping._first_text
+        fields = {"vat_total": 0.0}
+
+        for _, elem in etree.iterparse(
+            BytesIO(xml_bytes), events=("end",), tag=SCAN_TAGS, **SCAN_PARSER_OPTIONS
+        ):
+            parent = elem.getparent()
+            if parent is None or parent.getparent() is not None:
+                # Root, or a nested element with a matching tag (e.g. a line's cbc:ID)
+                continue
+
+            tag = elem.tag
+            if tag in SCAN_HEADER_FIELDS:
+                fields.setdefault(SCAN_HEADER_FIELDS[tag], elem.text or "")
+            elif tag == CAC_ACCOUNTING_SUPPLIER_PARTY:
+                fields.setdefault("supplier_name", first_text(XP_PARTY_NAME(elem)))
+            elif tag == CAC_ACCOUNTING_CUSTOMER_PARTY:
+                fields.setdefault("buyer_name", first_text(XP_PARTY_NAME(elem)))
+            elif tag == CAC_LEGAL_MONETARY_TOTAL:
+                fields.setdefault("total_amount", first(XP_PAYABLE_AMOUNT(elem)))
+            elif tag == CAC_TAX_TOTAL:
+                fields["vat_total"] += sum(map(float, XP_TAX_SUBTOTALS(elem)), 0.0)
+
+            # Free this child and any unmatched siblings that came before it
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+
+        return fields
+
     def process_incoming_invoice(self, msg_meta, msg_detail):
+        return self._import_invoices([self._parse_incoming_invoice(msg_meta, msg_detail)])[0]
+
+    def _parse_incoming_invoice(self, msg_meta, msg_detail) -> dict:
         b64_xml = msg_detail.get("document")
         if not b64_xml:
             return {"id": msg_meta["id"], "error": "No document found"}
 
-        xml_bytes = base64.b64decode(b64_xml)
-        root = etree.fromstring(xml_bytes)
+        # A malformed message is reported on its own instead of failing the run
+        # (binascii.Error from b64decode is a ValueError, as is a bad amount)
+        try:
+            xml_bytes = base64.b64decode(b64_xml)
+            fields = self._scan_invoice(xml_bytes)
 
-        ns = {
-            "cbc": "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2",
-            "cac": "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"
-        }
+            total_amount = fields.get("total_amount")
+            fields["total_amount"] = float(total_amount) if total_amount else 0.0
+        except (etree.XMLSyntaxError, ValueError) as exc:
+            return {"id": msg_meta["id"], "error": str(exc)}
 
-        invoice_id = root.findtext("cbc:ID", namespaces=ns)
-        issue_date = root.findtext("cbc:IssueDate", namespaces=ns)
-        currency = root.findtext("cbc:DocumentCurrencyCode", namespaces=ns)
+        fields["message_id"] = msg_meta["id"]
+        return fields
 
-        supplier_name = root.findtext("cac:AccountingSupplierParty/cac:Party/cac:PartyName/cbc:Name", namespaces=ns)
-        buyer_name = root.findtext("cac:AccountingCustomerParty/cac:Party/cac:PartyName/cbc:Name", namespaces=ns)
+    def _lookup_user_ids(self, companies) -> dict:
+        """
+        Map company names to the ids of existing Users. Names not in
+        self._user_by_company are looked up with a single query; companies
+        without a User are left out.
+        """
+        user_ids = {}
+        missing = []
+        for company in companies:
+            if company in self._user_by_company:
+                user_ids[company] = self._user_by_company[company]
+            else:
+                missing.append(company)
+
+        if not missing:
+            return user_ids
+
+        # Descending so that, as with .first(), the oldest match wins
+        rows = (
+            self.session.query(User.company, User.id)
+            .filter(User.company.in_(missing))
+            .order_by(User.id.desc())
+        )
+        user_ids.update(rows)
+        return user_ids
 
-        total_amount = root.findtext("cac:LegalMonetaryTotal/cbc:PayableAmount", namespaces=ns)
-        total_amount = float(total_amount) if total_amount else 0.0
+    def _import_invoices(self, parsed) -> list:
+        """
+        Store parsed incoming invoices in a single database transaction.
 
-        vat_total = 0.0
-        for ts in root.findall("cac:TaxTotal/cac:TaxSubtotal", namespaces=ns):
-            vat_amount = ts.findtext("cbc:TaxAmount", namespaces=ns)
-            if vat_amount:
-                vat_total += float(vat_amount)
+        Each invoice is written inside its own savepoint, so one that fails to
+        import is rolled back on its own and returned as an "error" entry while
+        the others are still committed. Entries already carrying an "error" are
+        passed through unchanged; results keep the input order.
+        """
+        pending = [fields for fields in parsed if "error" not in fields]
+        if not pending:
+            return list(parsed)
+
+        results = {}
+        try:
+            companies = {fields.get("supplier_name") for fields in pending}
+            companies |= {fields.get("buyer_name") for fields in pending}
+            user_ids = self._lookup_user_ids(companies)
+
+            for fields in pending:
+                created = []
+                try:
+                    with self.session.begin_nested():
+                        results[id(fields)] = self._import_invoice(fields, user_ids, created)
+                except (SQLAlchemyError, ValueError) as exc:
+                    # Users added for this invoice were rolled back with it
+                    for company in created:
+                        del user_ids[company]
+                    results[id(fields)] = {"id": fields["message_id"], "error": str(exc)}
 
-        # Ensure supplier and buyer exist as Users
-        supplier = self.session.query(User).filter_by(company=supplier_name).first()
-        if not supplier:
-            supplier = User(company=supplier_name)
-            self.session.add(supplier)
             self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
 
-        buyer = self.session.query(User).filter_by(company=buyer_name).first()
-        if not buyer:
-            buyer = User(company=buyer_name)
-            self.session.add(buyer)
-            self.session.commit()
+        # Only cache ids once they are committed; a failed commit leaves the cache untouched
+        self._user_by_company.update(user_ids)
 
-        # Create transaction
-        start_dt = datetime.fromisoformat(issue_date) if issue_date else datetime.utcnow()
+        return [results.get(id(fields), fields) for fields in parsed]
+
+    def _import_invoice(self, fields, user_ids, created) -> dict:
+        """
+        Add the Users, Transaction and Invoice for one parsed invoice and flush
+        them. Companies that get a new User are added to user_ids and created.
+        """
+        for company in (fields.get("supplier_name"), fields.get("buyer_name")):
+            if company not in user_ids:
+                user = User(company=company)
+                self.session.add(user)
+                self.session.flush()
+                user_ids[company] = user.id
+                created.append(company)
+
+        issue_date = fields.get("issue_date")
+        start = datetime.fromisoformat(issue_date) if issue_date else datetime.utcnow()
         record = self.create_transaction_record(
-            name=f"Invoice {invoice_id}",
-            from_user_id=supplier.id,
-            to_user_id=buyer.id,
-            value=total_amount - vat_total,
-            vat=vat_total,
+            name=f"Invoice {fields.get('invoice_id')}",
+            from_user_id=user_ids[fields.get("supplier_name")],
+            to_user_id=user_ids[fields.get("buyer_name")],
+            value=fields["total_amount"] - fields["vat_total"],
+            vat=fields["vat_total"],
             vat_recovery=1.0,
-            currency=currency or "EUR",
-            start=start_dt,
-            annotation=f"Imported from Peppol message {msg_meta['id']}"
+            currency=fields.get("currency") or "EUR",
+            start=start,
+            annotation=f"Imported from Peppol message {fields['message_id']}",
+            commit=False
         )
+        self.session.flush()
 
-        # Store invoice record
         inv = Invoice()
-        inv.external_id = invoice_id
-        inv.peppol_message_id = msg_meta["id"]
-        inv.supplier_id = supplier.id
-        inv.buyer_id = buyer.id
-        inv.issue_date = start_dt
-        inv.currency = currency or "EUR"
-        inv.total_amount = total_amount
-        inv.vat_amount = vat_total
+        inv.external_id = fields.get("invoice_id")
+        inv.peppol_message_id = fields["message_id"]
+        inv.supplier_id = record.from_user_id
+        inv.buyer_id = record.to_user_id
+        inv.issue_date = start
+        inv.currency = fields.get("currency") or "EUR"
+        inv.total_amount = fields["total_amount"]
+        inv.vat_amount = fields["vat_total"]
         inv.transaction_id = record.id
-
         self.session.add(inv)
-        self.session.commit()
+        self.session.flush()
 
+        # Collect generated ids before commit expires the instances
         return {
-            "message_id": msg_meta["id"],
-            "invoice_id": invoice_id,
-            "supplier": supplier_name,
-            "buyer": buyer_name,
+            "message_id": fields["message_id"],
+            "invoice_id": fields.get("invoice_id"),
+            "supplier": fields.get("supplier_name"),
+            "buyer": fields.get("buyer_name"),
             "date": issue_date,
-            "total": total_amount,
-            "vat": vat_total,
+            "total": fields["total_amount"],
+            "vat": fields["vat_total"],
             "transaction_id": record.id,
             "invoice_db_id": inv.id
         }
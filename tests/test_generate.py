@@ -0,0 +1,41 @@
+from datetime import date
+
+from lxml import etree
+
+from peppolling import PeppolBookkeeping
+from peppolling.peppol_bookkeeping import NS, User
+
+
+def generate(items):
+    bk = PeppolBookkeeping(db_url="sqlite://")
+    supplier = User(company="Test Supplier", peppol_id="0208:0123456789")
+    buyer = User(company="Test Buyer", peppol_id="0208:0999999999")
+    xml_bytes = bk.generate_invoice_xml(supplier, buyer, items, "TEST-INV-001", date(2025, 1, 1))
+    return etree.fromstring(xml_bytes)
+
+
+def texts(root, path):
+    return [el.text for el in root.findall(path, namespaces=NS)]
+
+
+def test_generate_invoice_totals():
+    root = generate([
+        {"name": "Hours", "quantity": 1.5, "unit_price": 33.333, "vat_pct": 0.21},
+        {"name": "Screws", "quantity": 3, "unit_price": 0.005, "vat_pct": 0.21},
+        {"name": "Discount", "quantity": 1, "unit_price": -2.5, "vat_pct": 0.21},
+        {"name": "Book", "quantity": "0.125", "unit_price": "7.77", "vat_pct": "0.06"},
+        {"name": "Export", "quantity": 2, "unit_price": 1.1, "vat_pct": -0.1},
+    ])
+
+    assert texts(root, "cac:InvoiceLine/cbc:LineExtensionAmount") == ["50.00", "0.03", "-2.50", "0.97", "2.20"]
+    assert texts(root, "cac:InvoiceLine/cac:Price/cbc:PriceAmount") == ["33.33", "0.01", "-2.50", "7.77", "1.10"]
+    assert texts(root, "cac:InvoiceLine/cac:Item/cac:ClassifiedTaxCategory/cbc:Percent") == [
+        "21.00", "21.00", "21.00", "6.00", "0.00"
+    ]
+
+    assert texts(root, "cac:TaxTotal/cbc:TaxAmount") == ["10.04"]
+    assert texts(root, "cac:TaxTotal/cac:TaxSubtotal/cbc:TaxableAmount") == ["47.53", "0.97", "2.20"]
+    assert texts(root, "cac:TaxTotal/cac:TaxSubtotal/cbc:TaxAmount") == ["9.98", "0.06", "0.00"]
+
+    assert texts(root, "cac:LegalMonetaryTotal/cbc:TaxExclusiveAmount") == ["50.70"]
+    assert texts(root, "cac:LegalMonetaryTotal/cbc:PayableAmount") == ["60.74"]
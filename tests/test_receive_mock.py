@@ -1,8 +1,14 @@
 import base64
+from datetime import date
 from pathlib import Path
 from unittest.mock import patch, MagicMock
 
+import pytest
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
 from peppolling import PeppolBookkeeping
+from peppolling.peppol_bookkeeping import Invoice, User
 
 FIXTURE = Path(__file__).parent / "fixtures" / "invoice_minimal.xml"
 
@@ -16,7 +22,9 @@ def test_receive_invoices_mock():
 
     fake_detail = {"document": b64}
 
-    with patch("requests.get") as mock_get:
+    bk = PeppolBookkeeping(peppol_api_key="dummy")
+
+    with patch.object(bk.http, "get") as mock_get:
         mock_list_resp = MagicMock()
         mock_list_resp.status_code = 200
         mock_list_resp.json.return_value = fake_list
@@ -27,9 +35,179 @@ def test_receive_invoices_mock():
 
         mock_get.side_effect = [mock_list_resp, mock_detail_resp]
 
-        bk = PeppolBookkeeping(peppol_api_key="dummy")
-
         results = bk.receive_invoices()
 
         assert len(results) == 1
         assert results[0]["invoice_id"] == "TEST-INV-001"
+
+
+def test_receive_invoices_batch_mock():
+    xml_bytes = FIXTURE.read_bytes()
+    b64 = base64.b64encode(xml_bytes).decode()
+
+    fake_list = [{"id": "1"}, {"id": "2"}, {"id": "3"}]
+
+    bk = PeppolBookkeeping(db_url="sqlite://", peppol_api_key="dummy")
+
+    with patch.object(bk.http, "get") as mock_get:
+        mock_list_resp = MagicMock()
+        mock_list_resp.status_code = 200
+        mock_list_resp.json.return_value = fake_list
+
+        mock_detail_resp = MagicMock()
+        mock_detail_resp.status_code = 200
+        mock_detail_resp.json.return_value = {"document": b64}
+
+        mock_missing_resp = MagicMock()
+        mock_missing_resp.status_code = 404
+
+        def fake_get(url, **kwargs):
+            if url.endswith("list"):
+                return mock_list_resp
+            if url.endswith("/2"):
+                return mock_missing_resp
+            return mock_detail_resp
+
+        mock_get.side_effect = fake_get
+
+        results = bk.receive_invoices()
+
+    assert [r["message_id"] for r in results] == ["1", "3"]
+    assert results[0]["transaction_id"] != results[1]["transaction_id"]
+    assert bk.session.query(User).count() == 2
+    assert bk.session.query(Invoice).count() == 2
+
+
+def test_receive_invoices_batch_with_bad_invoices_mock():
+    xml_bytes = FIXTURE.read_bytes()
+    no_supplier = xml_bytes.replace(b"<cbc:Name>Mock Supplier</cbc:Name>", b"", 1)
+    bad_date = xml_bytes.replace(b"2025-01-01", b"not-a-date").replace(b"Mock Buyer", b"Other Buyer")
+    bad_amount = xml_bytes.replace(b">100.00<", b">abc<")
+    documents = {
+        "1": xml_bytes,
+        "2": no_supplier,
+        "3": bad_date,
+        "4": b"<not xml",
+        "5": bad_amount,
+        "6": xml_bytes,
+    }
+
+    bk = PeppolBookkeeping(db_url="sqlite://", peppol_api_key="dummy")
+
+    def fake_get(url, **kwargs):
+        resp = MagicMock()
+        resp.status_code = 200
+        if url.endswith("list"):
+            resp.json.return_value = [{"id": msg_id} for msg_id in documents]
+        else:
+            document = documents[url.rsplit("/", 1)[1]]
+            resp.json.return_value = {"document": base64.b64encode(document).decode()}
+        return resp
+
+    with patch.object(bk.http, "get", side_effect=fake_get):
+        results = bk.receive_invoices()
+
+    assert [r.get("message_id", r.get("id")) for r in results] == ["1", "2", "3", "4", "5", "6"]
+    assert ["error" in r for r in results] == [False, True, True, True, True, False]
+
+    # The bad invoices are rolled back, including the buyer only they referenced
+    assert sorted(u.company for u in bk.session.query(User)) == ["Mock Buyer", "Mock Supplier"]
+    assert bk.session.query(Invoice).count() == 2
+
+    # The session is still usable afterwards
+    result = bk.process_incoming_invoice({"id": "7"}, {"document": base64.b64encode(xml_bytes).decode()})
+    assert "error" not in result
+    assert bk.session.query(Invoice).count() == 3
+
+
+def test_import_reuses_cached_user_ids():
+    b64 = base64.b64encode(FIXTURE.read_bytes()).decode()
+    bk = PeppolBookkeeping(db_url="sqlite://")
+    bk.process_incoming_invoice({"id": "1"}, {"document": b64})
+    assert set(bk._user_by_company) == {"Mock Supplier", "Mock Buyer"}
+
+    statements = []
+    event.listen(bk.engine, "before_cursor_execute", lambda conn, cursor, statement, *args: statements.append(statement))
+    bk.process_incoming_invoice({"id": "2"}, {"document": b64})
+
+    assert not [s for s in statements if "FROM users" in s or "INSERT INTO users" in s]
+    assert bk.session.query(User).count() == 2
+
+
+def test_failed_commit_leaves_user_cache_empty():
+    b64 = base64.b64encode(FIXTURE.read_bytes()).decode()
+    bk = PeppolBookkeeping(db_url="sqlite://")
+
+    with patch.object(bk.session, "commit", side_effect=OperationalError("COMMIT", {}, Exception("disk full"))):
+        with pytest.raises(OperationalError):
+            bk.process_incoming_invoice({"id": "1"}, {"document": b64})
+
+    assert bk._user_by_company == {}
+    assert bk.session.query(User).count() == 0
+
+
+def test_process_incoming_invoice_vat_amount_is_exact():
+    tax_total = (
+        b"<cac:TaxTotal><cbc:TaxAmount>1.86</cbc:TaxAmount>"
+        b"<cac:TaxSubtotal><cbc:TaxAmount>1.86</cbc:TaxAmount></cac:TaxSubtotal></cac:TaxTotal>\n"
+        b"    <cac:LegalMonetaryTotal>"
+    )
+    xml_bytes = FIXTURE.read_bytes().replace(b"<cac:LegalMonetaryTotal>", tax_total, 1)
+    b64 = base64.b64encode(xml_bytes).decode()
+
+    bk = PeppolBookkeeping(db_url="sqlite://")
+    result = bk.process_incoming_invoice({"id": "654"}, {"document": b64})
+
+    assert result["vat"] == 1.86
+    assert bk.session.query(Invoice).one().vat_amount == 1.86
+
+
+def test_process_incoming_invoice_generated():
+    bk = PeppolBookkeeping(db_url="sqlite://")
+
+    supplier = User(company="Mock Supplier", peppol_id="0208:0123456789")
+    buyer = User(company="Mock Buyer", peppol_id="0208:0999999999")
+    items = [
+        {"name": "Widget", "quantity": 2, "unit_price": 10, "vat_pct": 0.21},
+        {"name": "Service", "quantity": 1, "unit_price": 50, "vat_pct": 0.06},
+    ]
+    xml_bytes = bk.generate_invoice_xml(supplier, buyer, items, "TEST-INV-002", date(2025, 1, 1))
+    b64 = base64.b64encode(xml_bytes).decode()
+
+    result = bk.process_incoming_invoice({"id": "456"}, {"document": b64})
+
+    assert result["invoice_id"] == "TEST-INV-002"
+    assert result["supplier"] == "Mock Supplier"
+    assert result["buyer"] == "Mock Buyer"
+    assert result["date"] == "2025-01-01"
+    assert result["total"] == 77.2
+    assert result["vat"] == 7.2
+
+
+def test_process_incoming_invoice_does_not_expand_entities(tmp_path):
+    secret = tmp_path / "secret.txt"
+    secret.write_text("SECRET")
+
+    xml_bytes = FIXTURE.read_bytes().replace(
+        b"<Invoice ",
+        b'<!DOCTYPE Invoice [<!ENTITY xxe SYSTEM "' + secret.as_uri().encode() + b'">]>\n<Invoice ',
+        1,
+    ).replace(b"<cbc:ID>TEST-INV-001</cbc:ID>", b"<cbc:ID>&xxe;</cbc:ID>", 1)
+    b64 = base64.b64encode(xml_bytes).decode()
+
+    bk = PeppolBookkeeping(db_url="sqlite://")
+    result = bk.process_incoming_invoice({"id": "789"}, {"document": b64})
+
+    assert "SECRET" not in (result["invoice_id"] or "")
+
+
+def test_process_incoming_invoice_empty_party_name():
+    xml_bytes = FIXTURE.read_bytes().replace(b"<cbc:Name>Mock Supplier</cbc:Name>", b"<cbc:Name/>", 1)
+    b64 = base64.b64encode(xml_bytes).decode()
+
+    bk = PeppolBookkeeping(db_url="sqlite://")
+    result = bk.process_incoming_invoice({"id": "321"}, {"document": b64})
+
+    assert result["supplier"] == ""
+    assert result["buyer"] == "Mock Buyer"
+    assert bk.session.query(User).filter_by(company="").count() == 1
@@ -6,7 +6,7 @@ def test_send_invoice_mock():
 
     xml_bytes = b"<Invoice></Invoice>"
 
-    with patch("requests.post") as mock_post:
+    with patch.object(bk.http, "post") as mock_post:
         mock_resp = MagicMock()
         mock_resp.status_code = 200
         mock_resp.text = '{"messageId": "ABC123"}'
@@ -16,3 +16,19 @@ def test_send_invoice_mock():
 
         assert status == 200
         assert "ABC123" in response
+
+        # The caller's buffer is handed to requests as-is, without a copy
+        assert mock_post.call_args.kwargs["data"] is xml_bytes
+        assert mock_post.call_args.kwargs["timeout"] == bk.HTTP_TIMEOUT
+
+
+def test_http_retry_policy():
+    bk = PeppolBookkeeping(db_url="sqlite://", peppol_api_key="dummy")
+
+    for prefix in ("https://", "http://"):
+        retry = bk.http.get_adapter(prefix + "api.test.peppyrus.be/").max_retries
+
+        # Status retries on GET only: a retried POST could send an invoice twice
+        assert retry.allowed_methods == {"GET"}
+        assert set(retry.status_forcelist) == {502, 503, 504}
+        assert retry.raise_on_status is False